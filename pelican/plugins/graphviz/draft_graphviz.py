@@ -0,0 +1,233 @@
+"""Draft mode for the Graphviz plugin for Pelican."""
+
+# Copyright (C) 2026  Rafael Laboissière
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Affero Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#
+# In draft mode, the diagrams that have not been rendered yet are replaced
+# by a placeholder element and rendered on a background thread pool.  The
+# placeholders carry a key identifying the diagram and its configuration.
+# Each output file is scanned for placeholders when Pelican writes it, and
+# is rewritten in place as soon as the diagrams it contains are rendered.
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from .run_graphviz import diagram_html, render_diagram
+from .trace_graphviz import diagram, with_context
+
+logger = logging.getLogger(__name__)
+
+# Attribute of the placeholder elements holding the key of the diagram
+DRAFT_ATTRIBUTE = "data-graphviz-draft"
+
+# Text of the placeholder elements
+DRAFT_TEXT = "Rendering diagram…"
+
+# Configuration entries that do not affect the HTML code of a diagram
+_IGNORED_CONFIG = ("block-start",)
+
+# The active draft renderer, or None when draft mode is disabled
+_drafts = None
+
+
+class Drafts:
+    """Render diagrams in the background and patch the output files."""
+
+    def __init__(self, budget, max_workers=None):
+        """Initialize the draft renderer.
+
+        The diagrams not rendered within budget seconds of the start of a
+        build are left as placeholders until the next build.
+
+        """
+        self.budget = budget
+        self.deadline = None
+        self.executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="graphviz-draft"
+        )
+        # Rendered diagrams: key -> ((svg, image), HTML code)
+        self.results = {}
+        # Diagrams being rendered
+        self.pending = set()
+        # Output files waiting for diagrams: key -> set of paths
+        self.waiting = {}
+        # Functions to be called once no diagram is pending
+        self.idle_callbacks = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(program, code, config):
+        """Return the key identifying a diagram and its configuration."""
+        fields = {k: v for k, v in config.items() if k not in _IGNORED_CONFIG}
+        data = json.dumps([program, code, fields], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode("utf-8"), usedforsecurity=False).hexdigest()
+
+    def lookup(self, renderer, program, code, config):
+        """Look up a rendered diagram, to be rendered with renderer.
+
+        Returns the key of the diagram and the (svg, image) pair returned by
+        render_diagram(), or None if the diagram is not rendered yet, in which
+        case it is queued for rendering.
+
+        """
+        key = self.key(program, code, config)
+        with self.lock:
+            if key in self.results:
+                return key, self.results[key][0]
+            if self.deadline is None:
+                self.deadline = time.monotonic() + self.budget
+            if key not in self.pending:
+                self.pending.add(key)
+                self.executor.submit(
+                    with_context(self._render),
+                    key,
+                    renderer,
+                    program,
+                    code,
+                    config,
+                    deadline=self.deadline,
+                )
+        return key, None
+
+    def _render(self, key, renderer, program, code, config, *, deadline):
+        try:
+            if time.monotonic() > deadline:
+                logger.warning(
+                    "Draft rendering budget exhausted, "
+                    "diagram %s left as a placeholder",
+                    key[:12],
+                )
+                return
+            with diagram(program, code):
+                svg, image = render_diagram(renderer, program, code, config)
+                fragment = diagram_html(svg, config, image)
+            with self.lock:
+                self.results[key] = ((svg, image), fragment)
+                for path in self.waiting.pop(key, set()):
+                    self._rewrite(path)
+        except Exception:
+            # Nobody waits for the result of the executor, so the error
+            # would go unnoticed otherwise
+            logger.exception("Cannot render diagram %s", key[:12])
+        finally:
+            # Let the next builds retry the diagrams that were not rendered
+            with self.lock:
+                self.pending.discard(key)
+                callbacks = [] if self.pending else self.idle_callbacks
+                if callbacks:
+                    self.idle_callbacks = []
+            for callback in callbacks:
+                callback()
+
+    def when_idle(self, callback):
+        """Call callback once the pending diagrams are rendered."""
+        with self.lock:
+            if self.pending:
+                self.idle_callbacks.append(callback)
+                return
+        callback()
+
+    def written(self, path):
+        """Take note of the placeholders in an output file."""
+        if not path.endswith(".html"):
+            return
+        with open(path, encoding="utf-8") as fid:
+            keys = set(re.findall(rf'{DRAFT_ATTRIBUTE}="([0-9a-f]+)"', fid.read()))
+        if not keys:
+            return
+        with self.lock:
+            for key in keys - self.results.keys():
+                self.waiting.setdefault(key, set()).add(path)
+            if keys & self.results.keys():
+                self._rewrite(path)
+
+    def _rewrite(self, path):
+        """Replace the placeholders of the rendered diagrams in a file.
+
+        Must be called with the lock held.
+
+        """
+        with open(path, encoding="utf-8") as fid:
+            content = fid.read()
+
+        def replace(m):
+            result = self.results.get(m.group(2))
+            return m.group(0) if result is None else result[1]
+
+        content, count = re.subn(
+            rf'<(\w+)[^>]*\b{DRAFT_ATTRIBUTE}="([0-9a-f]+)"[^>]*>.*?</\1>',
+            replace,
+            content,
+            flags=re.DOTALL,
+        )
+        if count:
+            # Replace the file atomically, since it may be served or written
+            # by the next build at the same time
+            fd, tmpname = tempfile.mkstemp(
+                dir=os.path.dirname(path), prefix=".tmp-", suffix=".html"
+            )
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as fid:
+                    fid.write(content)
+                os.chmod(tmpname, stat.S_IMODE(os.stat(path).st_mode))
+                os.replace(tmpname, path)
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+
+    def finalize(self):
+        """Start a new time budget with the next build."""
+        with self.lock:
+            self.deadline = None
+
+
+def placeholder(key, config):
+    """Return the placeholder element for a diagram not rendered yet."""
+    elt = ET.Element(config["html-element"])
+    elt.set("class", f"{config['image-class']} graphviz-draft")
+    elt.set(DRAFT_ATTRIBUTE, key)
+    elt.text = DRAFT_TEXT
+    return elt
+
+
+def configure_drafts(settings):
+    """Enable draft mode according to the settings, or disable it."""
+    global _drafts  # noqa: PLW0603
+    if not settings.get("GRAPHVIZ_DRAFT"):
+        _drafts = None
+    elif _drafts is None:
+        _drafts = Drafts(
+            settings.get("GRAPHVIZ_DRAFT_BUDGET"),
+            settings.get("GRAPHVIZ_MAX_WORKERS"),
+        )
+    else:
+        # Keep the diagrams rendered so far when the settings are reloaded
+        _drafts.budget = settings.get("GRAPHVIZ_DRAFT_BUDGET")
+    return _drafts
+
+
+def get_drafts():
+    """Return the active draft renderer, or None when draft mode is disabled."""
+    return _drafts
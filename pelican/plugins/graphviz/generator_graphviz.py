@@ -0,0 +1,188 @@
+"""Generator of Graphviz images for the Graphviz plugin for Pelican."""
+
+# Copyright (C) 2026  Rafael Laboissière
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Affero Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from pelican.generators import Generator
+
+from .renderers import make_renderer
+from .run_graphviz import DotRuntimeError
+from .trace_graphviz import article, diagram
+
+logger = logging.getLogger(__name__)
+
+# Name of the file, in CACHE_PATH, recording the rendered files
+MANIFEST_FILE = "graphviz-manifest.json"
+
+# Settings affecting the rendered images, which are rendered again when
+# any of them changes
+RENDER_SETTINGS = (
+    "GRAPHVIZ_DOT_PROGRAM",
+    "GRAPHVIZ_DOT_FORMAT",
+    "GRAPHVIZ_RENDERER",
+    "GRAPHVIZ_DETERMINISTIC",
+    "GRAPHVIZ_SPLIT_COMPONENTS",
+)
+
+
+class GraphvizGenerator(Generator):
+    """Render the Graphviz files of the content tree into the output tree.
+
+    The files found under GRAPHVIZ_DOT_PATHS with one of the extensions in
+    GRAPHVIZ_DOT_EXTENSIONS are rendered in the GRAPHVIZ_DOT_FORMAT format,
+    at the same relative path in the output directory.  A manifest in
+    CACHE_PATH records the hash of each rendered source, so that the files
+    that did not change are not rendered again, and that the images of the
+    removed files are deleted.
+
+    """
+
+    def generate_context(self):
+        self.sources = sorted(
+            self.get_files(
+                self.settings["GRAPHVIZ_DOT_PATHS"],
+                extensions=self.settings["GRAPHVIZ_DOT_EXTENSIONS"],
+            )
+        )
+
+    def generate_output(self, writer):
+        manifest_path = os.path.join(self.settings["CACHE_PATH"], MANIFEST_FILE)
+        try:
+            with open(manifest_path, encoding="utf-8") as fid:
+                manifest = json.load(fid)
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = {}
+
+        if not self.sources and not manifest:
+            return
+
+        outputs = {source: self.output_name(source) for source in self.sources}
+        current = set(outputs.values())
+
+        # Delete the images of the removed sources, and those whose name
+        # changed, for instance with GRAPHVIZ_DOT_FORMAT
+        for source, entry in list(manifest.items()):
+            if outputs.get(source) != entry["output"]:
+                self.delete(entry["output"], current)
+                if source not in outputs:
+                    del manifest[source]
+
+        jobs = []
+        for source in self.sources:
+            with open(os.path.join(self.path, source), encoding="utf-8") as fid:
+                code = fid.read()
+            digest = self.digest(code)
+            output = outputs[source]
+            entry = manifest.get(source)
+            if (
+                entry is None
+                or entry["hash"] != digest
+                or entry["output"] != output
+                or not os.path.exists(os.path.join(self.output_path, output))
+            ):
+                jobs.append((source, code, digest, output))
+
+        renderer = make_renderer(self.settings)
+        try:
+            if jobs and not renderer.available():
+                return
+            # Graphviz does the work, so threads are enough to keep all the
+            # cores busy
+            max_workers = self.settings["GRAPHVIZ_MAX_WORKERS"]
+            with ThreadPoolExecutor(max_workers) as executor:
+                results = executor.map(
+                    lambda job: self.render(renderer, job[0], job[1], job[3]), jobs
+                )
+                for (source, _, digest, output), ok in zip(jobs, results, strict=True):
+                    if ok:
+                        manifest[source] = {"hash": digest, "output": output}
+                    else:
+                        manifest.pop(source, None)
+        finally:
+            renderer.close()
+
+        self.write_manifest(manifest_path, manifest)
+
+    @staticmethod
+    def write_manifest(path, manifest):
+        """Write the manifest atomically, not to leave it truncated."""
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fid:
+                json.dump(manifest, fid, indent=2, sort_keys=True)
+            os.replace(tmpname, path)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+    def digest(self, code):
+        """Return the hash of a source and of the settings used to render it."""
+        data = json.dumps(
+            [
+                *(self.settings[name] for name in RENDER_SETTINGS),
+                code,
+            ]
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def delete(self, output, outputs):
+        """Delete an image, unless it is also the image of a current source."""
+        path = os.path.join(self.output_path, output)
+        if output not in outputs and os.path.exists(path):
+            logger.info("Deleting %s", path)
+            os.remove(path)
+
+    def output_name(self, source):
+        """Return the path of the image of a source, relative to the output."""
+        root, _ = os.path.splitext(source)
+        return f"{root}.{self.settings['GRAPHVIZ_DOT_FORMAT']}"
+
+    def render(self, renderer, source, code, output):
+        """Render a source into the output directory, returning the success."""
+        program = self.settings["GRAPHVIZ_DOT_PROGRAM"]
+        try:
+            with article(source), diagram(program, code):
+                data = renderer.render(
+                    program, code, image_format=self.settings["GRAPHVIZ_DOT_FORMAT"]
+                )
+            path = os.path.join(self.output_path, output)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fid:
+                fid.write(data)
+        except DotRuntimeError as err:
+            logger.error(  # noqa: TRY400
+                "Could not render %s: %s", source, err.errmsg.strip()
+            )
+            return False
+        except Exception:
+            # Do not lose the manifest of the other sources
+            logger.exception("Could not render %s", source)
+            return False
+        logger.info("Writing %s", path)
+        return True
+
+
+def get_generators(pelicanobj):
+    """Return the generator of the Graphviz files."""
+    return GraphvizGenerator
@@ -15,16 +15,21 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see http://www.gnu.org/licenses/.
 
+import functools
 import logging
 import os
-import subprocess
 
 from docutils.parsers.rst import directives
 
 from pelican import signals
 
+from .draft_graphviz import configure_drafts, get_drafts
+from .generator_graphviz import get_generators
 from .mdx_graphviz import GraphvizExtension
+from .renderers import close_renderers, make_renderer
 from .rst_graphviz import make_graphviz_directive
+from .run_graphviz import check_formats
+from .trace_graphviz import article, configure_tracing, get_tracer
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +41,33 @@ def initialize(pelicanobj):
     pelicanobj.settings.setdefault("GRAPHVIZ_HTML_ELEMENT", "div")
     pelicanobj.settings.setdefault("GRAPHVIZ_COMPRESS", True)
     pelicanobj.settings.setdefault("GRAPHVIZ_ALT_TEXT", "[GRAPH]")
+    pelicanobj.settings.setdefault("GRAPHVIZ_FORMAT", "svg")
+    pelicanobj.settings.setdefault("GRAPHVIZ_AUTO_FORMATS", ["png"])
+    pelicanobj.settings.setdefault("GRAPHVIZ_DPI", 96)
+    pelicanobj.settings.setdefault("GRAPHVIZ_SVG_BIAS", 1.0)
+    pelicanobj.settings.setdefault("GRAPHVIZ_DRAFT", False)
+    pelicanobj.settings.setdefault("GRAPHVIZ_DRAFT_BUDGET", 60)
+    pelicanobj.settings.setdefault("GRAPHVIZ_TRACE", None)
+    pelicanobj.settings.setdefault("GRAPHVIZ_DAEMON_SOCKET", None)
+    pelicanobj.settings.setdefault(
+        "GRAPHVIZ_RENDERER",
+        "daemon" if pelicanobj.settings.get("GRAPHVIZ_DAEMON_SOCKET") else "subprocess",
+    )
+    pelicanobj.settings.setdefault("GRAPHVIZ_MAX_WORKERS", None)
+    pelicanobj.settings.setdefault("GRAPHVIZ_SPLIT_COMPONENTS", False)
+    pelicanobj.settings.setdefault("GRAPHVIZ_DETERMINISTIC", False)
+    pelicanobj.settings.setdefault("GRAPHVIZ_DOT_PATHS", ["diagrams"])
+    pelicanobj.settings.setdefault("GRAPHVIZ_DOT_EXTENSIONS", ["dot", "gv"])
+    pelicanobj.settings.setdefault("GRAPHVIZ_DOT_PROGRAM", "dot")
+    pelicanobj.settings.setdefault("GRAPHVIZ_DOT_FORMAT", "svg")
+
+    renderer = make_renderer(pelicanobj.settings)
+    if not renderer.available():
+        logger.warning(
+            "The dot program from Graphviz is not available. "
+            "The Graphviz plugin is deactivated."
+        )
+        return
 
     config = {
         "block-start": pelicanobj.settings.get("GRAPHVIZ_BLOCK_START"),
@@ -44,27 +76,78 @@ def initialize(pelicanobj):
         "compress": pelicanobj.settings.get("GRAPHVIZ_COMPRESS"),
         "alt-text": None,
         "alt-text-default": pelicanobj.settings.get("GRAPHVIZ_ALT_TEXT"),
+        "format": pelicanobj.settings.get("GRAPHVIZ_FORMAT"),
+        "auto-formats": pelicanobj.settings.get("GRAPHVIZ_AUTO_FORMATS"),
+        "dpi": pelicanobj.settings.get("GRAPHVIZ_DPI"),
+        "svg-bias": pelicanobj.settings.get("GRAPHVIZ_SVG_BIAS"),
     }
+    check_formats(config)
+    configure_drafts(pelicanobj.settings)
 
     if isinstance(
         pelicanobj.settings.get("MD_EXTENSIONS"), list
     ):  # pelican 3.6.3 and earlier
-        pelicanobj.settings["MD_EXTENSIONS"].append(GraphvizExtension(config))
+        pelicanobj.settings["MD_EXTENSIONS"].append(GraphvizExtension(config, renderer))
     else:
         pelicanobj.settings["MARKDOWN"].setdefault("extensions", []).append(
-            GraphvizExtension(config)
+            GraphvizExtension(config, renderer)
         )
 
-    directives.register_directive("graphviz", make_graphviz_directive(config))
+    directives.register_directive("graphviz", make_graphviz_directive(config, renderer))
+
+    # The readers are only instrumented when tracing is enabled
+    if configure_tracing(pelicanobj.settings.get("GRAPHVIZ_TRACE")) is not None:
+        signals.readers_init.connect(trace_readers)
+    else:
+        signals.readers_init.disconnect(trace_readers)
+
+
+@functools.cache
+def _traced_reader(cls):
+    """Return a subclass of a reader class tagging the spans with the source."""
+
+    def read(self, source_path):
+        path = os.path.relpath(source_path, self.settings["PATH"])
+        with article(path.replace(os.sep, "/")):
+            return cls.read(self, source_path)
+
+    return type(cls.__name__, (cls,), {"__doc__": cls.__doc__, "read": read})
+
+
+def trace_readers(readers):
+    """Tag the spans recorded while reading a source file with its path."""
+    for fmt, cls in readers.reader_classes.items():
+        # Readers can be disabled with a None value in the READERS setting
+        if cls is not None:
+            readers.reader_classes[fmt] = _traced_reader(cls)
+
+
+def rewrite_drafts(path, context):
+    """Patch the diagrams rendered in draft mode into an output file."""
+    drafts = get_drafts()
+    if drafts is not None:
+        drafts.written(path)
+
+
+def finalize(pelicanobj):
+    """Write the trace, if any, and close the renderers at the end of the build."""
+    tracer = get_tracer()
+    drafts = get_drafts()
+    if drafts is not None:
+        # The spans of the background rendering are written once it is done
+        if tracer is not None:
+            drafts.when_idle(tracer.write)
+        # The renderers are still in use by the background rendering
+        drafts.finalize()
+    else:
+        if tracer is not None:
+            tracer.write()
+        close_renderers()
 
 
 def register():
     """Register the Markdown Graphviz plugin with Pelican."""
-    with open(os.devnull, "w") as fid:
-        if subprocess.call(["dot", "-V"], stderr=fid) == 0:
-            signals.initialized.connect(initialize)
-        else:
-            logger.warning(
-                "The dot program from Graphviz is not available. "
-                "The Graphviz plugin is deactivated."
-            )
+    signals.initialized.connect(initialize)
+    signals.get_generators.connect(get_generators)
+    signals.content_written.connect(rewrite_drafts)
+    signals.finalized.connect(finalize)
@@ -21,15 +21,18 @@ import xml.etree.ElementTree as ET
 from markdown import Extension
 from markdown.blockprocessors import BlockProcessor
 
-from .run_graphviz import append_base64_img, run_graphviz
+from .draft_graphviz import get_drafts, placeholder
+from .run_graphviz import append_base64_img, check_formats, render_diagram
+from .trace_graphviz import diagram, diagram_id, span
 
 
 class GraphvizProcessor(BlockProcessor):
     """Block processor for the Graphviz Markdown Extension."""
 
-    def __init__(self, md_parser, config):
+    def __init__(self, md_parser, config, renderer):
         """Class initialization."""
         self.config = config
+        self.renderer = renderer
         BlockProcessor.__init__(self, md_parser)
 
     def test(self, parent, block):
@@ -45,11 +48,13 @@ class GraphvizProcessor(BlockProcessor):
         # Get a local copy of the configuration hash
         config = self.config.copy()
 
-        m = re.match(
-            r"^{}\s+(?:\[(.*)\]\s+)?([^\s]+)".format(config["block-start"]),
-            block.split("\n")[0],
-        )
-        if m:
+        with span("parse") as args:
+            m = re.match(
+                r"^{}\s+(?:\[(.*)\]\s+)?([^\s]+)".format(config["block-start"]),
+                block.split("\n")[0],
+            )
+            if not m:
+                return
             # Gather local configuration values
             if m.group(1):
                 for keyval in re.findall(
@@ -62,39 +67,59 @@ class GraphvizProcessor(BlockProcessor):
                         config[key] = val == "yes"
                     else:
                         config[key] = val
+                check_formats(config, self.config)
             # Get the graphviz program name and the input code
             program = m.group(2)
             code = "\n".join(block.split("\n")[1:])
-        else:
-            return
+            args["diagram"] = diagram_id(program, code)
+
+        with diagram(program, code):
+            # In draft mode, insert a placeholder until the diagram is rendered
+            drafts = get_drafts()
+            if drafts is None:
+                result = render_diagram(self.renderer, program, code, config)
+            else:
+                key, result = drafts.lookup(self.renderer, program, code, config)
 
-        output = run_graphviz(program, code, image_format="svg")
+            if result is None:
+                parent.append(placeholder(key, config))
+                return
+            output, image = result
 
-        # Set HTML element
-        elt = ET.SubElement(parent, config["html-element"])
+            # Set HTML element
+            elt = ET.SubElement(parent, config["html-element"])
 
-        # Set CSS class
-        elt.set("class", config["image-class"])
+            # Set CSS class
+            elt.set("class", config["image-class"])
 
-        # Cope with compression
-        if config["compress"]:
-            append_base64_img(output, config, elt)
-        else:
-            svg = output.decode()
-            start = svg.find("<svg")
-            elt.text = "\n" + svg[start:]
+            # Cope with compression
+            if config["compress"]:
+                append_base64_img(output, config, elt, image)
+            else:
+                svg = output.decode()
+                start = svg.find("<svg")
+                elt.text = "\n" + svg[start:]
 
 
 class GraphvizExtension(Extension):
     """Markdow extension for Graphviz blocks."""
 
-    def __init__(self, config):
-        """Initialize the GraphvizExtension class."""
+    def __init__(self, config, renderer):
+        """Initialize the GraphvizExtension class.
+
+        The configuration holds the values that can be overridden by the
+        options of the blocks, the renderer is the backend rendering the
+        diagrams.
+
+        """
         self.config = config
+        self.renderer = renderer
 
     def extendMarkdown(self, md):
         """Add an instance of GraphvizProcessor to BlockParser."""
         md.registerExtension(self)
         md.parser.blockprocessors.register(
-            GraphvizProcessor(md.parser, self.config), "graphviz", 200
+            GraphvizProcessor(md.parser, self.config, self.renderer),
+            "graphviz",
+            200,
         )
@@ -0,0 +1,455 @@
+"""Renderer backends for the Graphviz plugin for Pelican."""
+
+# Copyright (C) 2026  Rafael Laboissière
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Affero Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+
+import base64
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import html
+import json
+import logging
+import os
+import re
+from shutil import which
+import socket
+import subprocess
+import threading
+from typing import NamedTuple, Protocol
+import weakref
+
+from .run_graphviz import (
+    MIME_TYPES,
+    DotRuntimeError,
+    canonicalize_svg,
+    pack_components,
+    render_packed,
+    run_graphviz,
+)
+from .trace_graphviz import diagram_id, with_context
+
+logger = logging.getLogger(__name__)
+
+# Number of packed layouts kept by the subprocess renderer
+_PACKED_CACHE_SIZE = 16
+
+# Formats assumed to be supported by dot when they cannot be probed
+_DEFAULT_FORMATS = frozenset(("svg", "png", "gif", "jpg"))
+
+
+def send_message(stream, message):
+    """Write a message as a line of JSON to a binary stream."""
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+def receive_message(stream):
+    """Read a line of JSON from a binary stream, or None at end of file."""
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+class UnknownRendererError(ValueError):
+    """Exception for an unknown GRAPHVIZ_RENDERER setting."""
+
+    def __init__(self, name):
+        """Emit the error message."""
+        super().__init__(
+            f"Unknown Graphviz renderer {name!r}, "
+            f"expected one of: {', '.join(sorted(RENDERERS))}"
+        )
+
+
+class RenderJob(NamedTuple):
+    """A diagram to be rendered by a renderer backend."""
+
+    program: str
+    code: str
+    options: list | None = None
+    image_format: str = "svg"
+
+
+class Capabilities(NamedTuple):
+    """What a renderer backend is able to do."""
+
+    # Image formats accepted by render() that can be embedded in a page
+    formats: frozenset
+    # Whether render_many() renders the jobs concurrently
+    parallel: bool = False
+
+
+class Renderer(Protocol):
+    """Interface of the renderer backends.
+
+    A renderer turns Graphviz code into image data.  The close() method
+    releases the resources held by the renderer (processes, threads,
+    sockets); the renderer must reacquire them if it is used afterwards,
+    since it is closed at the end of every build.
+
+    """
+
+    def available(self) -> bool: ...
+
+    def capabilities(self) -> Capabilities: ...
+
+    def render(self, program, code, options=None, image_format="svg") -> bytes: ...
+
+    def render_many(self, jobs) -> list: ...
+
+    def close(self) -> None: ...
+
+
+def _probe_formats():
+    """Return the image formats supported by dot that can be embedded.
+
+    Graphviz lists its output formats when it is asked for an unknown one.
+    The formats that are available in every build of Graphviz are
+    returned if the list cannot be obtained.
+
+    """
+    try:
+        result = subprocess.run(
+            ["dot", "-T?"],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=False,
+        )
+    except OSError:
+        return _DEFAULT_FORMATS
+    _, found, formats = result.stderr.decode("utf-8", "replace").partition(
+        "Use one of:"
+    )
+    if not found:
+        return _DEFAULT_FORMATS
+    # Formats are listed with their renderers, as in "png:cairo"
+    supported = {fmt.partition(":")[0] for fmt in formats.split()}
+    return frozenset(fmt for fmt in MIME_TYPES if fmt in supported)
+
+
+class SubprocessRenderer:
+    """Renderer running one Graphviz process per diagram."""
+
+    def __init__(self, settings):
+        """Initialize the renderer from the Pelican settings."""
+        self.max_workers = settings.get("GRAPHVIZ_MAX_WORKERS")
+        self.split_components = settings.get("GRAPHVIZ_SPLIT_COMPONENTS", False)
+        self.executor = None
+        self.formats = None
+        # Layouts of the components of the last diagrams, which are rendered
+        # several times by the "auto" format: (program, code) -> future
+        self.packed = OrderedDict()
+        self.lock = threading.Lock()
+
+    def available(self):
+        if self.split_components and not (which("ccomps") and which("gvpack")):
+            logger.warning(
+                "The ccomps and gvpack programs from Graphviz are not available. "
+                "The connected components will not be laid out separately."
+            )
+            self.split_components = False
+        with open(os.devnull, "w") as fid:
+            try:
+                return subprocess.call(["dot", "-V"], stderr=fid) == 0
+            except OSError:
+                return False
+
+    def capabilities(self):
+        if self.formats is None:
+            self.formats = _probe_formats()
+        return Capabilities(formats=self.formats, parallel=True)
+
+    def render(self, program, code, options=None, image_format="svg"):
+        if self.split_components:
+            packed = self._pack(program, code)
+            if packed is not None:
+                return render_packed(packed, options, image_format)
+        return run_graphviz(program, code, options, image_format)
+
+    def render_uncached(self, program, code, options=None, image_format="svg"):
+        """Render a diagram with Graphviz, without reusing any former result."""
+        if self.split_components:
+            packed = pack_components(program, code, self.max_workers)
+            if packed is not None:
+                return render_packed(packed, options, image_format)
+        return run_graphviz(program, code, options, image_format)
+
+    def _pack(self, program, code):
+        """Return the packed layout of a diagram, computing it only once."""
+        key = (program, code)
+        with self.lock:
+            future = self.packed.get(key)
+            owner = future is None
+            if owner:
+                future = self.packed[key] = Future()
+                if len(self.packed) > _PACKED_CACHE_SIZE:
+                    self.packed.popitem(last=False)
+        if owner:
+            try:
+                future.set_result(pack_components(program, code, self.max_workers))
+            # The error is raised by future.result() in every waiting thread
+            except Exception as err:  # noqa: BLE001
+                future.set_exception(err)
+                # Do not keep the errors, which may be transient
+                with self.lock:
+                    if self.packed.get(key) is future:
+                        del self.packed[key]
+        return future.result()
+
+    def render_many(self, jobs):
+        # The work is done by the Graphviz processes, so threads are
+        # enough to keep all the cores busy
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers)
+        return list(
+            self.executor.map(with_context(lambda job: self.render(*job)), jobs)
+        )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        with self.lock:
+            self.packed.clear()
+
+
+class DaemonRenderer(SubprocessRenderer):
+    """Renderer delegating the work to the render server.
+
+    The diagrams are sent to the server listening on the Unix socket given
+    by the GRAPHVIZ_DAEMON_SOCKET setting (see the server_graphviz module).
+    When the server cannot be reached, Graphviz is run directly instead.
+
+    """
+
+    def __init__(self, settings):
+        """Initialize the renderer from the Pelican settings."""
+        super().__init__(settings)
+        self.path = settings.get("GRAPHVIZ_DAEMON_SOCKET")
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.warned = False
+
+    def available(self):
+        return self._connect() is not None or super().available()
+
+    def render(self, program, code, options=None, image_format="svg"):
+        stream = self._connect()
+        if stream is not None:
+            request = {
+                "program": program,
+                "code": code,
+                "options": options,
+                "format": image_format,
+            }
+            try:
+                send_message(stream, request)
+                response = receive_message(stream)
+            except OSError:
+                response = None
+            if response is not None:
+                if not response["ok"]:
+                    raise DotRuntimeError(response["error"])
+                return base64.b64decode(response["data"])
+            # The server went away, forget about the connection
+            self.local.stream = None
+        return super().render(program, code, options, image_format)
+
+    def _connect(self):
+        """Return the connection of the current thread to the server."""
+        stream = getattr(self.local, "stream", None)
+        if stream is None and self.path is None:
+            if not self.warned:
+                logger.warning(
+                    "GRAPHVIZ_DAEMON_SOCKET is not set, running Graphviz directly."
+                )
+                self.warned = True
+            return None
+        if stream is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError as err:
+                sock.close()
+                if not self.warned:
+                    logger.warning(
+                        "Cannot connect to the Graphviz render server at %s (%s), "
+                        "running Graphviz directly.",
+                        self.path,
+                        err,
+                    )
+                    self.warned = True
+                return None
+            stream = sock.makefile("rwb")
+            self.local.stream = stream
+            with self.lock:
+                self.connections.append((sock, stream))
+        return stream
+
+    def close(self):
+        super().close()
+        with self.lock:
+            for sock, stream in self.connections:
+                stream.close()
+                sock.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+class StubRenderer:
+    """Renderer producing placeholder SVG images without running Graphviz.
+
+    The output mimics the parts of the SVG produced by dot that the plugin
+    relies upon, namely the title comment and the image dimensions.  This
+    renderer is meant for testing.
+
+    """
+
+    def __init__(self, settings):
+        """Initialize the renderer from the Pelican settings."""
+
+    def available(self):
+        return True
+
+    def capabilities(self):
+        return Capabilities(formats=frozenset(("svg",)))
+
+    def render(self, program, code, options=None, image_format="svg"):
+        if image_format not in self.capabilities().formats:
+            errmsg = f'Format: "{image_format}" not recognized.'
+            raise DotRuntimeError(errmsg)
+        m = re.search(r"^\s*(?:strict\s+)?(?:di)?graph\s*([^\s{]*)\s*{", code)
+        if not m:
+            errmsg = "Error: syntax error in line 1"
+            raise DotRuntimeError(errmsg)
+        title = html.escape(m.group(1).strip('"') or "%3")
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+            f"<!-- Title: {title} Pages: 1 -->\n"
+            '<svg width="8pt" height="8pt" viewBox="0.00 0.00 8.00 8.00"'
+            ' xmlns="http://www.w3.org/2000/svg">\n'
+            f'<g id="graph0" class="graph"><title>{title}</title></g>\n'
+            "</svg>\n"
+        ).encode()
+
+    def render_many(self, jobs):
+        return [self.render(*job) for job in jobs]
+
+    def close(self):
+        pass
+
+
+class DeterministicRenderer:
+    """Renderer wrapper making the output of another renderer reproducible.
+
+    The SVG images are canonicalized with canonicalize_svg().  In check mode,
+    each diagram is rendered twice, and a warning is issued if the two images
+    differ.  The second rendering uses the render_uncached() method of the
+    wrapped renderer, if any, since a renderer reusing its former results,
+    like the render server, would always return the same image.
+
+    """
+
+    def __init__(self, renderer, check=False):
+        """Wrap renderer, rendering each diagram twice if check is true."""
+        self.renderer = renderer
+        self.check = check
+        self.render_again = getattr(renderer, "render_uncached", renderer.render)
+
+    def available(self):
+        return self.renderer.available()
+
+    def capabilities(self):
+        return self.renderer.capabilities()
+
+    def render(self, program, code, options=None, image_format="svg"):
+        job = (program, code, options, image_format)
+        data = self._canonicalize(job, self.renderer.render(*job))
+        if self.check:
+            self._check(job, data)
+        return data
+
+    def render_many(self, jobs):
+        jobs = list(jobs)
+        images = [
+            self._canonicalize(job, data)
+            for job, data in zip(jobs, self.renderer.render_many(jobs), strict=True)
+        ]
+        if self.check:
+            for job, data in zip(jobs, images, strict=True):
+                self._check(job, data)
+        return images
+
+    def close(self):
+        self.renderer.close()
+
+    @staticmethod
+    def _canonicalize(job, data):
+        return canonicalize_svg(data) if job[3] == "svg" else data
+
+    def _check(self, job, data):
+        """Render a job again and warn if the image differs from data."""
+        if self._canonicalize(job, self.render_again(*job)) != data:
+            logger.warning(
+                "The %s output of %s is not deterministic for diagram %s",
+                job[3],
+                job[0],
+                diagram_id(job[0], job[1]),
+            )
+
+
+# Registry of the renderer backends, indexed by the values allowed for the
+# GRAPHVIZ_RENDERER setting
+RENDERERS = {
+    "subprocess": SubprocessRenderer,
+    "daemon": DaemonRenderer,
+    "stub": StubRenderer,
+}
+
+# Renderers created by make_renderer(), to be closed by close_renderers()
+_renderers = weakref.WeakSet()
+
+
+def register_renderer(name, factory):
+    """Register a renderer backend.
+
+    The factory is called with the Pelican settings and must return an
+    object implementing the Renderer protocol.
+
+    """
+    RENDERERS[name] = factory
+
+
+def make_renderer(settings):
+    """Create the renderer selected by the GRAPHVIZ_RENDERER setting."""
+    name = settings.get("GRAPHVIZ_RENDERER", "subprocess")
+    try:
+        factory = RENDERERS[name]
+    except KeyError:
+        raise UnknownRendererError(name) from None
+    renderer = factory(settings)
+    deterministic = settings.get("GRAPHVIZ_DETERMINISTIC", False)
+    if deterministic:
+        renderer = DeterministicRenderer(renderer, check=deterministic == "check")
+    _renderers.add(renderer)
+    return renderer
+
+
+def close_renderers():
+    """Close the renderers created by make_renderer()."""
+    for renderer in _renderers:
+        renderer.close()
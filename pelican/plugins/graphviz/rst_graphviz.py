@@ -15,7 +15,6 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 
-import html
 from typing import ClassVar
 import xml.etree.ElementTree as ET
 
@@ -23,7 +22,9 @@ from docutils import nodes
 from docutils.parsers.rst import Directive
 from docutils.parsers.rst.directives import unchanged
 
-from .run_graphviz import append_base64_img, run_graphviz
+from .draft_graphviz import get_drafts, placeholder
+from .run_graphviz import check_formats, diagram_html, render_diagram
+from .trace_graphviz import diagram, diagram_id, span
 
 
 def truthy(argument: str) -> bool:
@@ -36,11 +37,12 @@ def truthy(argument: str) -> bool:
     return argument.lower() in ("yes", "true", "on", "1")
 
 
-def make_graphviz_directive(base_config: dict):
+def make_graphviz_directive(base_config: dict, renderer):
     """Make a graphviz RST directive incorporating the plugin's configuration.
 
     Returns a Directive subclass that implements graphviz support, taking into
-    account the plugin's runtime configuration.
+    account the plugin's runtime configuration, and rendering the diagrams
+    with renderer.
 
     """
 
@@ -59,30 +61,37 @@ def make_graphviz_directive(base_config: dict):
             "html-element": unchanged,
             "compress": truthy,
             "alt-text": unchanged,
+            "format": unchanged,
+            "dpi": unchanged,
+            "svg-bias": unchanged,
         }
         has_content = True
 
         def run(self):
-            config = base_config.copy()
-            config.update(self.options)
-
-            program = self.arguments[0]
-            code = "\n".join(self.content)
-
-            output = run_graphviz(program, code, image_format="svg")
-
-            elt = ET.Element(config["html-element"])
-            elt.set("class", config["image-class"])
-
-            if config["compress"]:
-                append_base64_img(output, config, elt)
-                img_html = ET.tostring(elt, encoding="unicode", method="html")
-            else:
-                svg = output.decode()
-                start = svg.find("<svg")
-                tag = html.escape(config["html-element"], quote=True)
-                class_ = html.escape(config["image-class"], quote=True)
-                img_html = f'<{tag} class="{class_}">{svg[start:]}</{tag}>'
+            with span("parse") as args:
+                config = base_config.copy()
+                config.update(self.options)
+                check_formats(config, base_config)
+
+                program = self.arguments[0]
+                code = "\n".join(self.content)
+                args["diagram"] = diagram_id(program, code)
+
+            with diagram(program, code):
+                # In draft mode, insert a placeholder until the diagram is
+                # rendered
+                drafts = get_drafts()
+                if drafts is None:
+                    result = render_diagram(renderer, program, code, config)
+                else:
+                    key, result = drafts.lookup(renderer, program, code, config)
+
+                if result is None:
+                    elt = placeholder(key, config)
+                    img_html = ET.tostring(elt, encoding="unicode", method="html")
+                else:
+                    output, image = result
+                    img_html = diagram_html(output, config, image)
 
             svg_node = nodes.raw("", img_html, format="html")
             container = nodes.container("", svg_node, classes=["graphviz"])
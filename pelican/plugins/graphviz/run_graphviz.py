@@ -47,12 +47,54 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import errno
+import html
+import logging
+import math
 import os
 import re
 from subprocess import PIPE, Popen
+import tempfile
+from threading import Thread
 import xml.etree.ElementTree as ET
 
+from .trace_graphviz import get_tracer, span, with_context
+
+logger = logging.getLogger(__name__)
+
+# Name of the graph in DOT code, if any, after the leading comments
+_GRAPH_NAME_RE = re.compile(
+    r"^(?:\s+|/\*.*?\*/|//[^\n]*|#[^\n]*)*"
+    r'(?:strict\s+)?(?:di)?graph\b\s*("[^"]*"|[^\s{]+)?\s*{',
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Names given by Graphviz to anonymous graphs and subgraphs
+_AUTO_NAME_RE = re.compile(r"%\d+")
+
+# SVG attributes holding coordinates or lengths
+_GEOMETRY_ATTRIBUTES = (
+    "cx",
+    "cy",
+    "d",
+    "font-size",
+    "height",
+    "points",
+    "rx",
+    "ry",
+    "stroke-width",
+    "transform",
+    "viewBox",
+    "width",
+    "x",
+    "x1",
+    "x2",
+    "y",
+    "y1",
+    "y2",
+)
+
 
 class DotRuntimeError(RuntimeError):
     """Exception for dot program."""
@@ -60,20 +102,89 @@ class DotRuntimeError(RuntimeError):
     def __init__(self, errmsg):
         """Emit the error message."""
         super().__init__(f"dot exited with error:\n[stderr]\n{errmsg}")
+        self.errmsg = errmsg
+
+
+# MIME types of the image formats that can be embedded
+MIME_TYPES = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "webp": "image/webp",
+    "gif": "image/gif",
+    "jpg": "image/jpeg",
+}
+
+
+# Fallback values of the numeric options of the image format
+_FORMAT_DEFAULTS = {"dpi": 96.0, "svg-bias": 1.0}
+
+
+def _positive_number(value):
+    """Return value as a positive float, or None if it is not one."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) and number > 0 else None
+
+
+def check_formats(config: dict, fallback=None):
+    """Check the image format options of a configuration.
 
+    The formats that cannot be embedded, i.e. those missing from MIME_TYPES,
+    are replaced by "svg" in the format option and dropped from the
+    auto-formats option, with a warning.  The dpi and svg-bias options are
+    converted to positive numbers, the invalid values being replaced, with
+    a warning, by those of the fallback configuration, if given, or by the
+    defaults otherwise.  Returns the configuration.
 
-def append_base64_img(svg: bytes, config: dict, elt: ET.Element):
+    """
+    if config["format"] != "auto" and config["format"] not in MIME_TYPES:
+        logger.warning(
+            'Images in the "%s" format cannot be embedded, using "svg" instead',
+            config["format"],
+        )
+        config["format"] = "svg"
+    invalid = [fmt for fmt in config["auto-formats"] if fmt not in MIME_TYPES]
+    if invalid:
+        logger.warning(
+            "Images in the %s format cannot be embedded, ignoring them",
+            ", ".join(f'"{fmt}"' for fmt in invalid),
+        )
+        config["auto-formats"] = [
+            fmt for fmt in config["auto-formats"] if fmt in MIME_TYPES
+        ]
+    for key, default in _FORMAT_DEFAULTS.items():
+        value = _positive_number(config[key])
+        if value is None:
+            value = fallback[key] if fallback is not None else default
+            logger.warning(
+                'Invalid value "%s" for the %s option, using %g instead',
+                config[key],
+                key,
+                value,
+            )
+        config[key] = value
+    return config
+
+
+def append_base64_img(svg: bytes, config: dict, elt: ET.Element, image=None):
     """Apppend a base64 SVG img to an ElementTree element.
 
     Given a binary-encoded SVG image, base64-encodes the SVG and appends it to
-    the given element in the form of an inline img tag.
+    the given element in the form of an inline img tag.  If image is given, as
+    a (format, data) pair, it is embedded instead of the SVG, which is still
+    used for the alt text.
 
     """
+    image_format, data = image or ("svg", svg)
     img = ET.SubElement(elt, "img")
-    img.set(
-        "src",
-        f"data:image/svg+xml;base64,{base64.b64encode(svg).decode('ascii')}",
-    )
+    with span("encode", format=image_format, size=len(data)):
+        img.set(
+            "src",
+            f"data:{MIME_TYPES[image_format]};base64,"
+            f"{base64.b64encode(data).decode('ascii')}",
+        )
     # Set the alt text. Order of priority:
     #    1. Block option alt-text
     #    2. ID of Graphviz object
@@ -90,33 +201,170 @@ def append_base64_img(svg: bytes, config: dict, elt: ET.Element):
         # shipped with Ubuntu 24.04:
         #
         # https://gitlab.com/graphviz/graphviz/-/issues/1376
-        if m and m.group(1) != "%3":
+        #
+        # Other numbers may appear after "%", in particular "%0" in the
+        # output of canonicalize_svg().
+        if m and not _AUTO_NAME_RE.fullmatch(m.group(1)):
             img.set("alt", m.group(1))
         else:
             img.set("alt", config["alt-text-default"])
 
 
-def run_graphviz(program, code, options=None, image_format="png"):
-    """Run graphviz program and returns image data."""
-    if not options:
-        options = []
+def render_diagram(renderer, program, code, config: dict):
+    """Render a diagram with renderer according to the configuration.
 
-    dot_command = [program, *options, "-T", image_format]
+    Returns the SVG output of the Graphviz program and the image to be
+    embedded, as returned by select_image(), or None if the SVG output is
+    to be inserted uncompressed.
+
+    """
+    output = renderer.render(program, code, image_format="svg")
+    if not config["compress"]:
+        return output, None
+    return output, select_image(renderer, output, program, code, config)
+
+
+def diagram_html(svg: bytes, config: dict, image=None):
+    """Return the HTML code for a rendered diagram.
+
+    The diagram is enclosed in the HTML element given by the configuration,
+    either as an inline img tag, if compression is on, or as an svg tag.
+
+    """
+    elt = ET.Element(config["html-element"])
+    elt.set("class", config["image-class"])
+
+    if config["compress"]:
+        append_base64_img(svg, config, elt, image)
+        return ET.tostring(elt, encoding="unicode", method="html")
+
+    svg = svg.decode()
+    start = svg.find("<svg")
+    tag = html.escape(config["html-element"], quote=True)
+    class_ = html.escape(config["image-class"], quote=True)
+    return f'<{tag} class="{class_}">{svg[start:]}</{tag}>'
+
+
+def canonicalize_svg(svg: bytes) -> bytes:
+    """Remove the variable parts of the SVG output of Graphviz.
+
+    The comment giving the version of Graphviz is removed, the names given
+    to anonymous graphs are renumbered from "%0" in order of appearance,
+    and the numbers in the geometry attributes are rounded to two decimals,
+    without trailing zeros.
+
+    """
+    text = svg.decode("utf-8")
+    text = re.sub(r"<!-- Generated by graphviz .*? -->\n?", "", text, flags=re.DOTALL)
+
+    names = {}
+
+    def rename(m):
+        # Only the whole title can be an automatic name, a "%" followed by
+        # digits may also appear in the names given by the user
+        title = m.group(0)
+        if not _AUTO_NAME_RE.fullmatch(title):
+            return title
+        return names.setdefault(title, f"%{len(names)}")
+
+    text = re.sub(
+        r"(?<=<!-- Title: )[^\n]*?(?= Pages: \d+ -->)|(?<=<title>)[^<]*(?=</title>)",
+        rename,
+        text,
+    )
+
+    def number(m):
+        value = f"{round(float(m.group(0)), 2):.2f}".rstrip("0").rstrip(".")
+        return "0" if value == "-0" else value
+
+    def geometry(m):
+        return m.group(1) + re.sub(r"-?\d*\.\d+|-?\d+", number, m.group(2)) + '"'
+
+    text = re.sub(
+        rf'(\s(?:{"|".join(_GEOMETRY_ATTRIBUTES)})=")([^"]*)"',
+        geometry,
+        text,
+    )
+    return text.encode("utf-8")
+
+
+def _encoded_size(data):
+    """Return the length of the Base64 encoding of data."""
+    return 4 * ((len(data) + 2) // 3)
+
+
+def select_image(renderer, svg: bytes, program, code, config: dict):
+    """Select the image to be embedded according to the format option.
+
+    Returns a (format, data) pair.  For the "svg" format, this is the given
+    SVG image.  For the "auto" format, the SVG image and the images in the
+    formats listed in the auto-formats option are compared by the size of
+    their Base64 encoding, the one of the SVG image being divided by the
+    svg-bias option, and the smallest one is selected.  Otherwise, the
+    diagram is rendered in the requested format.
+
+    """
+    image_format = config["format"]
+    if image_format == "svg":
+        return "svg", svg
 
-    if os.name == "nt":
-        # Avoid opening shell window.
-        # * https://github.com/tkf/ipython-hierarchymagic/issues/1
-        # * http://stackoverflow.com/a/2935727/727827
-        p = Popen(
-            dot_command,
-            stdout=PIPE,
-            stdin=PIPE,
-            stderr=PIPE,
-            creationflags=0x08000000,
+    options = [f"-Gdpi={config['dpi']:g}"]
+    if image_format != "auto":
+        return image_format, renderer.render(program, code, options, image_format)
+
+    supported = renderer.capabilities().formats
+    candidates = [
+        fmt for fmt in config["auto-formats"] if fmt != "svg" and fmt in supported
+    ]
+    with span("select", candidates=candidates) as args:
+        images = renderer.render_many(
+            [(program, code, options, fmt) for fmt in candidates]
         )
-    else:
-        p = Popen(dot_command, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+        selected = ("svg", svg)
+        size = _encoded_size(svg) / config["svg-bias"]
+        for fmt, data in zip(candidates, images, strict=True):
+            if _encoded_size(data) < size:
+                selected, size = (fmt, data), _encoded_size(data)
+        args["selected"] = selected[0]
+    return selected
+
+
+def _feed_stdin(stream, data, errors):
+    """Write data to a child process's standard input and close it."""
+    try:
+        stream.write(data)
+    except OSError as err:
+        # Graphviz may close standard input when an error occurs,
+        # resulting in a broken pipe
+        if err.errno not in (errno.EPIPE, errno.EINVAL):
+            errors.append(err)
+    finally:
+        # Closing standard input must not be skipped, since Graphviz
+        # waits for the end of file before producing any output
+        try:
+            stream.close()
+        except OSError as err:
+            if err.errno not in (errno.EPIPE, errno.EINVAL):
+                errors.append(err)
+
+
+def _drain(stream, chunks, errors):
+    """Read a child process's output stream until end of file."""
+    try:
+        chunks.append(stream.read())
+    except OSError as err:
+        errors.append(err)
+    finally:
+        stream.close()
+
+
+def _communicate(p, code):
+    """Feed code to a Graphviz process and collect its output.
 
+    Returns the exit status and the standard output and error streams of
+    the process.
+
+    """
     # Initialize error flag variable
     wentwrong = False
 
@@ -135,8 +383,136 @@ def run_graphviz(program, code, options=None, image_format="png"):
         stdout, stderr = p.stdout.read(), p.stderr.read()
         p.wait()
 
-    if p.returncode != 0:
+    return p.returncode, stdout, stderr
+
+
+def _run_command(command, code):
+    """Run a Graphviz command over code.
+
+    Returns the exit status and the standard output and error streams of
+    the command.  When tracing is enabled, the process is driven by helper
+    threads, so that its layout and output stages can be told apart.
+
+    """
+    with span("spawn", program=command[0]):
+        if os.name == "nt":
+            # Avoid opening shell window.
+            # * https://github.com/tkf/ipython-hierarchymagic/issues/1
+            # * http://stackoverflow.com/a/2935727/727827
+            p = Popen(
+                command,
+                stdout=PIPE,
+                stdin=PIPE,
+                stderr=PIPE,
+                creationflags=0x08000000,
+            )
+        else:
+            p = Popen(command, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+
+    if get_tracer() is None:
+        return _communicate(p, code)
+
+    # Feed the code and collect the error messages in helper threads, so
+    # that the time spent waiting for the layout and the time spent
+    # reading the image data can be told apart
+    errors, stderr = [], []
+    helpers = [
+        Thread(target=_feed_stdin, args=(p.stdin, code.encode("utf-8"), errors)),
+        Thread(target=_drain, args=(p.stderr, stderr, errors)),
+    ]
+    for thread in helpers:
+        thread.start()
+
+    with span("layout"):
+        # Graphviz only writes the image once the layout is done
+        stdout = p.stdout.read(1)
+
+    with span("read"):
+        stdout += p.stdout.read()
+        p.stdout.close()
+        for thread in helpers:
+            thread.join()
+        p.wait()
+
+    if errors:
+        raise errors[0]
+
+    # The list is empty if the helper thread died of an unexpected error
+    return p.returncode, stdout, b"".join(stderr)
+
+
+def run_graphviz(program, code, options=None, image_format="png"):
+    """Run graphviz program and returns image data."""
+    if not options:
+        options = []
+
+    dot_command = [program, *options, "-T", image_format]
+
+    returncode, stdout, stderr = _run_command(dot_command, code)
+
+    if returncode != 0:
         errmsg = stderr.decode("utf-8")
         raise DotRuntimeError(errmsg)
 
     return stdout
+
+
+def pack_components(program, code, max_workers=None):
+    """Lay out each connected component of a graph in parallel.
+
+    The graph is split into its connected components with ccomps, each
+    component is laid out by a separate process of the graphviz program,
+    and the layouts are packed together with gvpack.  Returns the packed
+    layout, in the DOT language, to be rendered with "neato -n2 -s" in any
+    format, or None if the graph is connected.
+
+    """
+    with tempfile.TemporaryDirectory(prefix="graphviz-") as tmpdir:
+        # ccomps exits with a non-zero status whenever the graph is not
+        # connected, so its status is ignored: the errors in the code are
+        # reported by the graphviz program
+        _run_command(["ccomps", "-x", "-o", os.path.join(tmpdir, "c")], code)
+        components = []
+        for filename in sorted(os.listdir(tmpdir), key=_component_index):
+            with open(os.path.join(tmpdir, filename), encoding="utf-8") as fid:
+                components.append(fid.read())
+
+    if len(components) <= 1:
+        return None
+
+    # Graphviz does the work, so threads are enough to keep all the cores busy
+    with ThreadPoolExecutor(max_workers) as executor:
+        layouts = executor.map(
+            with_context(
+                lambda component: run_graphviz(program, component, None, "dot")
+            ),
+            components,
+        )
+        returncode, packed, stderr = _run_command(
+            ["gvpack", "-g"], b"".join(layouts).decode("utf-8")
+        )
+    if returncode != 0:
+        errmsg = stderr.decode("utf-8")
+        raise DotRuntimeError(errmsg)
+
+    # gvpack names the packed graph "root", give it back its original name,
+    # which is used for the alt text, or no name if it was anonymous
+    packed = packed.decode("utf-8")
+    name = _GRAPH_NAME_RE.match(code)
+    root = _GRAPH_NAME_RE.match(packed)
+    if root and root.group(1):
+        name = (name.group(1) if name else None) or ""
+        packed = packed[: root.start(1)] + name + packed[root.end(1) :]
+
+    return packed
+
+
+def render_packed(packed, options=None, image_format="png"):
+    """Render a layout returned by pack_components()."""
+    return run_graphviz("neato", packed, ["-n2", "-s", *(options or [])], image_format)
+
+
+def _component_index(filename):
+    """Return the index of a component in the name of a file written by ccomps."""
+    _, _, index = filename.rpartition("_")
+    return int(index) if index.isdigit() else 0
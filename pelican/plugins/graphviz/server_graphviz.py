@@ -0,0 +1,267 @@
+"""Render server for the Graphviz plugin for Pelican."""
+
+# Copyright (C) 2026  Rafael Laboissière
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Affero Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#
+# The server listens on a Unix domain socket and renders diagrams on behalf
+# of the Pelican builds running on the same host.  Results are kept in a
+# content-addressed cache shared by all the clients, and identical requests
+# received concurrently are rendered only once.  Start it with:
+#
+#     python -m pelican.plugins.graphviz.server_graphviz \
+#         --socket /tmp/graphviz.sock --cache-dir ~/.cache/pelican-graphviz
+#
+# and point the builds to it with the GRAPHVIZ_DAEMON_SOCKET setting.
+
+import argparse
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import signal
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+
+from .renderers import receive_message, send_message
+from .run_graphviz import DotRuntimeError, run_graphviz
+
+logger = logging.getLogger(__name__)
+
+# Programs the clients may run: the layout engines of Graphviz
+LAYOUT_ENGINES = frozenset(
+    ("circo", "dot", "fdp", "neato", "osage", "patchwork", "sfdp", "twopi")
+)
+
+# Permissions of the socket: only the user running the server may connect
+SOCKET_MODE = 0o600
+
+# Options the clients may pass: graph, node, and edge attributes, and the
+# layout engine
+_OPTION_RE = re.compile(r"-[GNE]\w+(?:=.*)?|-K\w+", re.DOTALL)
+
+
+class ForbiddenRequestError(ValueError):
+    """Exception for a request the server refuses to run."""
+
+    def __init__(self, what, value):
+        """Emit the error message."""
+        super().__init__(f"The render server does not accept the {what} {value!r}")
+
+
+def check_request(program, options):
+    """Check that a request only runs Graphviz and does not write files.
+
+    Raises ForbiddenRequestError otherwise.
+
+    """
+    if program not in LAYOUT_ENGINES:
+        raise ForbiddenRequestError("program", program)
+    for option in options or []:
+        if not isinstance(option, str) or not _OPTION_RE.fullmatch(option):
+            raise ForbiddenRequestError("option", option)
+        if option.startswith("-K") and option[2:] not in LAYOUT_ENGINES:
+            raise ForbiddenRequestError("option", option)
+
+
+def graphviz_version():
+    """Return the version banner of Graphviz, or an empty string if unknown."""
+    try:
+        result = subprocess.run(
+            ["dot", "-V"],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=False,
+        )
+    except OSError:
+        return ""
+    return result.stderr.decode("utf-8", "replace").strip()
+
+
+def cache_key(program, code, options, image_format, version=""):
+    """Return the content address of a rendering request.
+
+    The version of Graphviz is part of the address, so that the images
+    rendered before an upgrade are not served afterwards.
+
+    """
+    request = json.dumps([version, program, options or [], image_format, code])
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+class ContentCache:
+    """Cache of rendered images stored in files named after their key.
+
+    Files are written atomically, and a lock file per key serializes the
+    rendering of a given diagram across the processes sharing the cache.
+
+    """
+
+    def __init__(self, path):
+        """Initialize the cache, stored in the directory path."""
+        self.path = path
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.filename(key), "rb") as fid:
+                return fid.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        filename = self.filename(key)
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fid:
+                fid.write(data)
+            os.replace(tmpname, filename)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+    @contextmanager
+    def lock(self, key):
+        filename = self.filename(key) + ".lock"
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as fid:
+            fcntl.flock(fid, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fid, fcntl.LOCK_UN)
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    """Handle the rendering requests sent over a client connection."""
+
+    def handle(self):
+        while (request := receive_message(self.rfile)) is not None:
+            try:
+                check_request(request.get("program"), request.get("options"))
+                data = self.server.render(
+                    request["program"],
+                    request["code"],
+                    request.get("options"),
+                    request.get("format", "svg"),
+                )
+            except DotRuntimeError as err:
+                response = {"ok": False, "error": err.errmsg}
+            except (OSError, KeyError, ValueError) as err:
+                response = {"ok": False, "error": str(err)}
+            else:
+                response = {"ok": True, "data": base64.b64encode(data).decode()}
+            send_message(self.wfile, response)
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server rendering diagrams with a pool of worker threads."""
+
+    daemon_threads = True
+
+    def __init__(self, path, cache=None, workers=None, render=run_graphviz):
+        """Initialize the server, listening on the Unix socket path.
+
+        The diagrams are rendered by calling render, which has the same
+        signature as run_graphviz.
+
+        """
+        super().__init__(path, RenderHandler)
+        self.cache = cache
+        self.render_function = render
+        self.version = graphviz_version()
+        self.executor = ThreadPoolExecutor(workers)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def server_bind(self):
+        super().server_bind()
+        # Restrict the access to the socket before it starts listening
+        os.chmod(self.server_address, SOCKET_MODE)
+
+    def render(self, program, code, options=None, image_format="svg"):
+        """Render a diagram, sharing the work with identical requests."""
+        key = cache_key(program, code, options, image_format, self.version)
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.executor.submit(
+                    self._render, key, program, code, options, image_format
+                )
+                self.inflight[key] = future
+        return future.result()
+
+    def _render(self, key, program, code, options, image_format):
+        try:
+            if self.cache is None:
+                return self.render_function(program, code, options, image_format)
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+            with self.cache.lock(key):
+                # Another process may have rendered it while we waited
+                data = self.cache.get(key)
+                if data is None:
+                    data = self.render_function(program, code, options, image_format)
+                    self.cache.put(key, data)
+                return data
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+        os.unlink(self.server_address)
+
+
+def main(argv=None):
+    """Run the render server until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--socket", required=True, help="path of the socket")
+    parser.add_argument("--cache-dir", help="directory of the shared cache")
+    parser.add_argument("--workers", type=int, help="number of worker threads")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Clean up when terminated as well as when interrupted
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Remove the socket left behind by a server that did not exit cleanly
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    cache = ContentCache(args.cache_dir) if args.cache_dir else None
+    with RenderServer(args.socket, cache, args.workers) as server:
+        logger.info("Graphviz render server listening on %s", args.socket)
+        with suppress(KeyboardInterrupt):
+            server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
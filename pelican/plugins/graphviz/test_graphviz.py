@@ -16,18 +16,36 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see http://www.gnu.org/licenses/.
 
+import base64
+import errno
+import json
 import os
 import re
-from shutil import rmtree
+from shutil import rmtree, which
+import stat
 from tempfile import mkdtemp
+import threading
+import time
 import unittest
+from unittest import mock
+from unittest.mock import ANY
 
 from bs4 import BeautifulSoup, Tag
 
 from pelican import Pelican
 from pelican.settings import read_settings
 
-from . import graphviz
+from . import graphviz, renderers
+from .draft_graphviz import DRAFT_ATTRIBUTE, Drafts
+from .generator_graphviz import MANIFEST_FILE, GraphvizGenerator
+from .renderers import (
+    DaemonRenderer,
+    DeterministicRenderer,
+    StubRenderer,
+    SubprocessRenderer,
+    register_renderer,
+)
+from .run_graphviz import MIME_TYPES, DotRuntimeError, canonicalize_svg
 
 TEST_FILE_STEM = "test"
 TEST_DIR_PREFIX = "pelicantests."
@@ -53,6 +71,8 @@ class TestGraphviz(unittest.TestCase):
             "md_block_start": "..graphviz",
             "options": None,
             "digraph_id": "G",
+            "edges": "Hello -> World",
+            "prefix": "",
         }
         if config is not None:
             self.config.update(config)
@@ -73,10 +93,16 @@ class TestGraphviz(unittest.TestCase):
             "html_element": "div",
             "image_class": "graphviz",
             "alt_text": "G",
+            "image_format": "svg",
         }
         if expected is not None:
             self.expected.update(expected)
 
+    def graph_header(self):
+        """Return the code of the graph preceding its body."""
+        graph_id = self.config["digraph_id"]
+        return f"{self.config['prefix']}digraph{f' {graph_id}' if graph_id else ''}"
+
     def test_md(self):
         options_string = ""
         if self.config["options"]:
@@ -100,9 +126,9 @@ class TestGraphviz(unittest.TestCase):
             fid.write(
                 f"""
 {self.config["md_block_start"]} {options_string} dot
-digraph{f" {self.config['digraph_id']}" if self.config["digraph_id"] else ""} {{
+{self.graph_header()} {{
   graph [rankdir = LR];
-  Hello -> World
+  {self.config["edges"]}
 }}
 """
             )
@@ -132,9 +158,9 @@ digraph{f" {self.config['digraph_id']}" if self.config["digraph_id"] else ""} {{
 .. graphviz:: dot
 {options_string}
 
-   digraph{f" {self.config['digraph_id']}" if self.config["digraph_id"] else ""} {{
+   {self.graph_header()} {{
      graph [rankdir = LR];
-     Hello -> World
+     {self.config["edges"]}
    }}
 """
             fid.write(rst_input)
@@ -168,6 +194,9 @@ digraph{f" {self.config['digraph_id']}" if self.config["digraph_id"] else ""} {{
 
                 img = elt.find("img", attrs={"alt": self.expected["alt_text"]})
                 assert img is not None, content
+
+                mime_type = MIME_TYPES[self.expected["image_format"]]
+                assert img["src"].startswith(f"data:{mime_type};base64,"), content
             else:
                 svg = soup.find("svg")
                 assert isinstance(svg, Tag), content
@@ -317,3 +346,512 @@ class TestGraphvizAltTextViaOption(TestGraphviz):
             config={"options": {"alt-text": text}},
             expected={"alt_text": text},
         )
+
+
+class TestGraphvizRendererOption(TestGraphviz):
+    """Class for testing that a block cannot replace the renderer."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(config={"options": {"renderer": "x"}})
+
+    @unittest.skip("reStructuredText rejects the unknown options")
+    def test_rst(self):
+        pass
+
+
+class TestGraphvizAutoFormat(TestGraphviz):
+    """Class for exercising the "auto" value of GRAPHVIZ_FORMAT.
+
+    The SVG bias is set so low that the PNG image is always smaller.
+
+    """
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(
+            settings={"GRAPHVIZ_FORMAT": "auto", "GRAPHVIZ_SVG_BIAS": 1e-6},
+            expected={"image_format": "png"},
+        )
+
+
+class TestGraphvizAutoFormatOption(TestGraphviz):
+    """Class for exercising the format and svg-bias options."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(
+            config={"options": {"format": "auto", "svg-bias": "1e6"}},
+            expected={"image_format": "svg"},
+        )
+
+
+class TestGraphvizFormatOptionInvalid(TestGraphviz):
+    """Class for testing a format that cannot be embedded."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(
+            config={"options": {"format": "pdf"}},
+            expected={"image_format": "svg"},
+        )
+
+
+class TestGraphvizAutoFormatOptionInvalid(TestGraphviz):
+    """Class for testing invalid values of the dpi and svg-bias options.
+
+    The values of the settings are used instead, with which the PNG image
+    is smaller.
+
+    """
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(
+            config={"options": {"format": "auto", "dpi": "x", "svg-bias": "0"}},
+            expected={"image_format": "png"},
+        )
+
+
+class TestGraphvizAutoFormatsInvalid(TestGraphviz):
+    """Class for testing GRAPHVIZ_AUTO_FORMATS with formats that cannot be embedded.
+
+    The SVG bias is set so low that any other image would be selected.
+
+    """
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(
+            settings={
+                "GRAPHVIZ_FORMAT": "auto",
+                "GRAPHVIZ_AUTO_FORMATS": ["pdf", "jpeg"],
+                "GRAPHVIZ_SVG_BIAS": 1e-6,
+            },
+            expected={"image_format": "svg"},
+        )
+
+
+class TestGraphvizSplitComponents(TestGraphviz):
+    """Class for exercising configuration variable GRAPHVIZ_SPLIT_COMPONENTS."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(settings={"GRAPHVIZ_SPLIT_COMPONENTS": True})
+
+
+@unittest.skipUnless(
+    which("ccomps") and which("gvpack"), "ccomps and gvpack are not available"
+)
+class TestGraphvizSplitComponentsDisconnected(TestGraphviz):
+    """Class for laying out the components of a disconnected graph."""
+
+    def setUp(self, config=None, expected=None):
+        """Initialize the configuration."""
+        super().setUp(
+            config={"edges": "Hello -> World; Foo -> Bar", **(config or {})},
+            settings={"GRAPHVIZ_SPLIT_COMPONENTS": True},
+            expected=expected,
+        )
+
+
+class TestGraphvizSplitComponentsAnonymous(TestGraphvizSplitComponentsDisconnected):
+    """Class for laying out the components of an anonymous disconnected graph."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(config={"digraph_id": None}, expected={"alt_text": "[GRAPH]"})
+
+
+class TestGraphvizSplitComponentsComment(TestGraphvizSplitComponentsDisconnected):
+    """Class for laying out the components of a graph following a comment."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(config={"prefix": "/* Greetings */ "})
+
+
+class TestGraphvizSplitComponentsAutoFormat(TestGraphvizSplitComponentsDisconnected):
+    """Class for laying out the components once for all the formats."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(expected={"image_format": "png"})
+        self.settings.update({"GRAPHVIZ_FORMAT": "auto", "GRAPHVIZ_SVG_BIAS": 1e-6})
+
+    def run_pelican(self):
+        with mock.patch.object(
+            renderers, "pack_components", wraps=renderers.pack_components
+        ) as pack:
+            super().run_pelican()
+        assert pack.call_count == 1, pack.call_args_list
+
+
+class TestGraphvizDeterministic(TestGraphviz):
+    """Class for exercising configuration variable GRAPHVIZ_DETERMINISTIC."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(settings={"GRAPHVIZ_DETERMINISTIC": "check"})
+
+    def assert_expected_output(self):
+        """Test that the version of Graphviz does not appear in the image."""
+        super().assert_expected_output()
+        with open(os.path.join(self.output_path, f"{TEST_FILE_STEM}.html")) as fid:
+            soup = BeautifulSoup(fid.read(), "html.parser")
+        src = soup.find("img")["src"]
+        svg = base64.b64decode(src.partition("base64,")[2]).decode("utf-8")
+        assert "<!-- Title: G Pages: 1 -->" in svg, svg
+        assert "Generated by graphviz" not in svg, svg
+
+
+class TestCanonicalizeSvg(unittest.TestCase):
+    """Class for testing the canonicalization of the SVG output."""
+
+    def test_canonicalize_svg(self):
+        svg = b"""\
+<!-- Generated by graphviz version 2.43.0 (0)
+ -->
+<!-- Title: %3 Pages: 1 -->
+<svg width="62.004pt" height="116pt" viewBox="0.00 0.00 62.00 116.00">
+<g id="graph0" class="graph" transform="translate(4 -0.001)">
+<title>%3</title>
+<g id="clust1" class="cluster"><title>%7</title></g>
+<g id="node1" class="node"><title>load 50%2</title>
+<ellipse cx="-0.004" cy="18.126" rx="27" ry="18"/></g>
+<g id="edge1" class="edge"><title>x%9&#45;&gt;y</title></g>
+</g>
+</svg>
+"""
+        assert (
+            canonicalize_svg(svg)
+            == b"""\
+<!-- Title: %0 Pages: 1 -->
+<svg width="62pt" height="116pt" viewBox="0 0 62 116">
+<g id="graph0" class="graph" transform="translate(4 0)">
+<title>%0</title>
+<g id="clust1" class="cluster"><title>%1</title></g>
+<g id="node1" class="node"><title>load 50%2</title>
+<ellipse cx="0" cy="18.13" rx="27" ry="18"/></g>
+<g id="edge1" class="edge"><title>x%9&#45;&gt;y</title></g>
+</g>
+</svg>
+"""
+        )
+
+
+class TestDeterministicRenderer(unittest.TestCase):
+    """Class for testing the check mode of the deterministic renderer."""
+
+    def test_check_uncached(self):
+        """Test that the second rendering does not reuse the first one."""
+        renderer = mock.Mock()
+        renderer.render.return_value = b"first"
+        renderer.render_uncached.return_value = b"second"
+        deterministic = DeterministicRenderer(renderer, check=True)
+        with self.assertLogs(DeterministicRenderer.__module__, "WARNING"):
+            data = deterministic.render("dot", "digraph G { a }", None, "png")
+        assert data == b"first"
+        renderer.render_uncached.assert_called_once()
+
+
+class TestGraphvizDraft(TestGraphviz):
+    """Class for exercising configuration variable GRAPHVIZ_DRAFT."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(settings={"GRAPHVIZ_DRAFT": True, "GRAPHVIZ_RENDERER": "stub"})
+
+    def assert_expected_output(self):
+        """Test that the placeholders are eventually replaced."""
+        path = os.path.join(self.output_path, f"{TEST_FILE_STEM}.html")
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with open(path) as fid:
+                if DRAFT_ATTRIBUTE not in fid.read():
+                    break
+            time.sleep(0.01)
+        super().assert_expected_output()
+
+
+class TestGraphvizTrace(TestGraphviz):
+    """Class for exercising configuration variable GRAPHVIZ_TRACE."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp()
+        self.trace_path = os.path.join(self.content_path, "trace.json")
+        self.settings["GRAPHVIZ_TRACE"] = self.trace_path
+
+    def assert_expected_output(self):
+        """Test that the trace file contains spans for each stage."""
+        super().assert_expected_output()
+        with open(self.trace_path) as fid:
+            trace = json.load(fid)
+        spans = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+        names = {e["name"] for e in spans}
+        assert {"parse", "spawn", "layout", "read", "encode"} <= names, names
+        for event in spans:
+            assert event["args"]["article"].startswith(TEST_FILE_STEM), event
+            assert event["args"]["diagram"], event
+
+
+class TestGraphvizTraceAutoFormat(TestGraphvizTrace):
+    """Class for tracing the diagrams rendered by the threads of a renderer."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp()
+        self.settings.update({"GRAPHVIZ_FORMAT": "auto", "GRAPHVIZ_SVG_BIAS": 1e-6})
+        self.expected["image_format"] = "png"
+
+
+class TestGraphvizStubRenderer(TestGraphviz):
+    """Class for exercising configuration variable GRAPHVIZ_RENDERER."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(settings={"GRAPHVIZ_RENDERER": "stub"})
+
+
+class TestGraphvizStubRendererNoCompress(TestGraphviz):
+    """Class for exercising the stub renderer with uncompressed output."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(
+            settings={"GRAPHVIZ_RENDERER": "stub", "GRAPHVIZ_COMPRESS": False},
+            expected={"compressed": False},
+        )
+
+
+class SlowStubRenderer(StubRenderer):
+    """Stub renderer taking its time, so that it outlasts the build."""
+
+    def render(self, *args, **kwargs):
+        time.sleep(0.5)
+        return super().render(*args, **kwargs)
+
+
+register_renderer("slow-stub", SlowStubRenderer)
+
+
+class FailingStubRenderer(StubRenderer):
+    """Stub renderer failing on the graphs named Fail, as if Graphviz crashed."""
+
+    def render(self, program, code, *args, **kwargs):
+        if "Fail" in code:
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+        return super().render(program, code, *args, **kwargs)
+
+
+register_renderer("failing-stub", FailingStubRenderer)
+
+
+class TestGraphvizDraftTrace(TestGraphvizDraft):
+    """Class for tracing the background rendering of draft mode."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp()
+        self.settings["GRAPHVIZ_RENDERER"] = "slow-stub"
+        self.trace_path = os.path.join(self.content_path, "trace.json")
+        self.settings["GRAPHVIZ_TRACE"] = self.trace_path
+
+    def assert_expected_output(self):
+        """Test that the trace is written once the diagrams are rendered."""
+        super().assert_expected_output()
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.trace_path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with open(self.trace_path) as fid:
+            trace = json.load(fid)
+        names = {e["name"] for e in trace["traceEvents"] if e["ph"] == "X"}
+        assert "encode" in names, names
+
+
+class TestGraphvizDraftOption(TestGraphvizDraft):
+    """Class for testing that a block cannot replace the draft renderer."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp()
+        self.config["options"] = {"draft": "no"}
+
+    @unittest.skip("reStructuredText rejects the unknown options")
+    def test_rst(self):
+        pass
+
+
+class TestGraphvizDraftError(unittest.TestCase):
+    """Class for testing the errors of the background rendering."""
+
+    def test_unknown_program(self):
+        """Test that a failed diagram is logged and can be retried."""
+        drafts = Drafts(60)
+        renderer = SubprocessRenderer({})
+        config = {"compress": True}
+        with self.assertLogs(Drafts.__module__, "ERROR"):
+            key, result = drafts.lookup(
+                renderer, "nosuchprog", "digraph G { a }", config
+            )
+            drafts.executor.shutdown()
+        assert result is None
+        assert key not in drafts.pending
+
+
+class TestGraphvizDaemonNoSocket(TestGraphviz):
+    """Class for testing the daemon renderer without GRAPHVIZ_DAEMON_SOCKET."""
+
+    def setUp(self):
+        """Initialize the configuration."""
+        super().setUp(settings={"GRAPHVIZ_RENDERER": "daemon"})
+
+
+@unittest.skipIf(os.name == "nt", "the render server needs Unix domain sockets")
+class TestGraphvizDaemon(TestGraphviz):
+    """Class for exercising configuration variable GRAPHVIZ_DAEMON_SOCKET."""
+
+    def setUp(self):
+        """Start a render server backed by the stub renderer."""
+        # The server relies on fcntl, which is not available on Windows
+        from .server_graphviz import (  # noqa: PLC0415
+            SOCKET_MODE,
+            ContentCache,
+            RenderServer,
+        )
+
+        super().setUp()
+        self.cache_path = mkdtemp(prefix=TEST_DIR_PREFIX)
+        socket_path = os.path.join(self.cache_path, "graphviz.sock")
+        self.server = RenderServer(
+            socket_path,
+            ContentCache(self.cache_path),
+            render=StubRenderer({}).render,
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.settings["GRAPHVIZ_DAEMON_SOCKET"] = socket_path
+        self.socket_mode = SOCKET_MODE
+
+    def assert_expected_output(self):
+        """Test that the diagram went through the server cache."""
+        super().assert_expected_output()
+        cached = [
+            name
+            for _, _, names in os.walk(self.cache_path)
+            for name in names
+            if not name.endswith((".lock", ".sock"))
+        ]
+        assert len(cached) == 1, cached
+        mode = os.stat(self.settings["GRAPHVIZ_DAEMON_SOCKET"]).st_mode
+        assert stat.S_IMODE(mode) == self.socket_mode, oct(mode)
+
+    def test_forbidden(self):
+        """Test that the server only runs the Graphviz layout engines."""
+        renderer = DaemonRenderer(self.settings)
+        for program, options in [("sh", None), ("dot", ["-o", "/tmp/foo"])]:
+            with self.assertRaisesRegex(DotRuntimeError, "does not accept"):
+                renderer.render(program, "digraph G { a }", options)
+        renderer.close()
+
+    def tearDown(self):
+        """Stop the render server."""
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.cache_path)
+        super().tearDown()
+
+
+class TestGraphvizGenerator(unittest.TestCase):
+    """Class for testing the rendering of the Graphviz files."""
+
+    def setUp(self):
+        """Set up the test environment."""
+        self.output_path = mkdtemp(prefix=TEST_DIR_PREFIX)
+        self.content_path = mkdtemp(prefix=TEST_DIR_PREFIX)
+        self.cache_path = mkdtemp(prefix=TEST_DIR_PREFIX)
+        os.mkdir(os.path.join(self.content_path, "diagrams"))
+        self.settings = {
+            "PATH": self.content_path,
+            "OUTPUT_PATH": self.output_path,
+            "CACHE_PATH": self.cache_path,
+            "PLUGINS": [graphviz],
+            "GRAPHVIZ_RENDERER": "stub",
+        }
+
+    def write_source(self, name, code):
+        with open(os.path.join(self.content_path, "diagrams", name), "w") as fid:
+            fid.write(code)
+
+    def run_pelican(self):
+        settings = read_settings(override=self.settings)
+        pelican = Pelican(settings=settings)
+        pelican.run()
+
+    def output_file(self, name):
+        return os.path.join(self.output_path, "diagrams", name)
+
+    def test_generator(self):
+        self.write_source("a.dot", "digraph A { a -> b }")
+        self.write_source("b.gv", "digraph B { c -> d }")
+        self.write_source("c.txt", "digraph C { e -> f }")
+        self.run_pelican()
+
+        with open(self.output_file("a.svg")) as fid:
+            assert "<!-- Title: A Pages: 1 -->" in fid.read()
+        assert os.path.exists(self.output_file("b.svg"))
+        assert not os.path.exists(self.output_file("c.svg"))
+
+        # Unchanged sources are not rendered again, removed ones are deleted
+        os.utime(self.output_file("a.svg"), (0, 0))
+        os.remove(os.path.join(self.content_path, "diagrams", "b.gv"))
+        self.run_pelican()
+
+        assert os.path.getmtime(self.output_file("a.svg")) == 0
+        assert not os.path.exists(self.output_file("b.svg"))
+
+    def test_settings_change(self):
+        self.write_source("a.dot", "digraph A { a -> b }")
+        self.run_pelican()
+
+        # The images are rendered again when the settings change
+        os.utime(self.output_file("a.svg"), (0, 0))
+        self.settings["GRAPHVIZ_DETERMINISTIC"] = True
+        self.run_pelican()
+
+        assert os.path.getmtime(self.output_file("a.svg")) != 0
+
+    def test_error(self):
+        self.settings["GRAPHVIZ_RENDERER"] = "failing-stub"
+        self.write_source("a.dot", "digraph A { a -> b }")
+        self.write_source("b.dot", "digraph Fail { c -> d }")
+        with self.assertLogs(GraphvizGenerator.__module__, "ERROR"):
+            self.run_pelican()
+
+        assert os.path.exists(self.output_file("a.svg"))
+        assert not os.path.exists(self.output_file("b.svg"))
+        with open(os.path.join(self.cache_path, MANIFEST_FILE)) as fid:
+            assert list(json.load(fid)) == ["diagrams/a.dot"]
+
+    def test_format_change(self):
+        self.write_source("a.dot", "digraph A { a -> b }")
+        self.run_pelican()
+        assert os.path.exists(self.output_file("a.svg"))
+
+        # The image in the former format is deleted
+        self.settings["GRAPHVIZ_RENDERER"] = "subprocess"
+        self.settings["GRAPHVIZ_DOT_FORMAT"] = "png"
+        self.run_pelican()
+
+        assert os.path.exists(self.output_file("a.png"))
+        assert not os.path.exists(self.output_file("a.svg"))
+        with open(os.path.join(self.cache_path, MANIFEST_FILE)) as fid:
+            assert json.load(fid) == {
+                "diagrams/a.dot": {"hash": ANY, "output": "diagrams/a.png"}
+            }
+
+    def tearDown(self):
+        """Tidy up the test environment."""
+        rmtree(self.output_path)
+        rmtree(self.content_path)
+        rmtree(self.cache_path)
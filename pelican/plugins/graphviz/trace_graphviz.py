@@ -0,0 +1,167 @@
+"""Timeline tracing for the Graphviz plugin for Pelican."""
+
+# Copyright (C) 2026  Rafael Laboissière
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Affero Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see http://www.gnu.org/licenses/.
+#
+#
+# The trace file follows the Chrome Trace Event format, which can be
+# opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing:
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Path of the source file being read, attached to every span
+_article: ContextVar[str | None] = ContextVar("graphviz_article", default=None)
+
+# Identifier of the diagram being processed, attached to every span
+_diagram: ContextVar[str | None] = ContextVar("graphviz_diagram", default=None)
+
+# The active tracer, or None when tracing is disabled
+_tracer = None
+
+
+class Tracer:
+    """Collect spans and write them as Chrome Trace Event JSON."""
+
+    def __init__(self, path):
+        """Initialize the tracer, which will write its events to path."""
+        self.path = path
+        self.origin = time.perf_counter_ns()
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **args):
+        """Record the time spent in the body of the with statement.
+
+        Yields the dictionary of span arguments, so that values only known
+        inside the body can still be attached to the span.
+
+        """
+        for key, var in (("article", _article), ("diagram", _diagram)):
+            value = var.get()
+            if value is not None:
+                args.setdefault(key, value)
+        start = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter_ns()
+            thread = threading.current_thread()
+            event = {
+                "name": name,
+                "cat": "graphviz",
+                "ph": "X",
+                "ts": (start - self.origin) / 1000,
+                "dur": (end - start) / 1000,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": args,
+            }
+            with self.lock:
+                self.threads[thread.ident] = thread.name
+                self.events.append(event)
+
+    def write(self):
+        """Write the collected events to the trace file and reset them."""
+        with self.lock:
+            events, self.events = self.events, []
+            metadata = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": ident,
+                    "args": {"name": name},
+                }
+                for ident, name in self.threads.items()
+            ]
+        with open(self.path, "w") as fid:
+            json.dump(
+                {"traceEvents": metadata + events, "displayTimeUnit": "ms"},
+                fid,
+            )
+
+
+def configure_tracing(path):
+    """Enable tracing to the file path, or disable it if path is None."""
+    global _tracer  # noqa: PLW0603
+    _tracer = Tracer(path) if path else None
+    return _tracer
+
+
+def get_tracer():
+    """Return the active tracer, or None when tracing is disabled."""
+    return _tracer
+
+
+@contextmanager
+def span(name, **args):
+    """Record a span with the active tracer, if any."""
+    if _tracer is None:
+        yield args
+    else:
+        with _tracer.span(name, **args) as span_args:
+            yield span_args
+
+
+def diagram_id(program, code):
+    """Return a short identifier for the diagram given by program and code."""
+    digest = hashlib.sha1(f"{program}\n{code}".encode(), usedforsecurity=False)
+    return digest.hexdigest()[:12]
+
+
+@contextmanager
+def article(path):
+    """Tag the spans recorded in the body with the path of a source file."""
+    token = _article.set(path)
+    try:
+        yield
+    finally:
+        _article.reset(token)
+
+
+@contextmanager
+def diagram(program, code):
+    """Tag the spans recorded in the body with the diagram identifier."""
+    token = _diagram.set(diagram_id(program, code))
+    try:
+        yield
+    finally:
+        _diagram.reset(token)
+
+
+def with_context(function):
+    """Return a wrapper calling function in a copy of the current context.
+
+    The context variables are not inherited by the threads of an executor,
+    so the work submitted to them must be wrapped for its spans to be
+    tagged with the article and the diagram.
+
+    """
+    context = copy_context()
+
+    def wrapper(*args, **kwargs):
+        # A context cannot be entered by several threads at once
+        return context.copy().run(function, *args, **kwargs)
+
+    return wrapper